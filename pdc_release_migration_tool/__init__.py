@@ -3,20 +3,32 @@
 # Licensed under The MIT License (MIT)
 # http://opensource.org/licenses/MIT
 
+import re
 import copy
 import json
 import pprint
+import fnmatch
 import operator
 
+try:
+    STRING_TYPES = basestring
+except NameError:
+    STRING_TYPES = str
+
 
 class PdcReleaseMigrationTool(object):
 
     NAME = "PdcReleaseMigrationTool"
     BATCH_SIZE = 100
 
+    REGEX_PREFIX = "re:"
+    GLOB_CHARS = "*?["
+    REGEX_CHARS = ".^$*+?{}[]\\|()"
+
     def __init__(self, client, logger=None, test=False):
         self.client = client
         self._test = test
+        self._plan = None  # List of plan steps when planning
 
         self._releases = []
         self._release_variants = []
@@ -93,12 +105,36 @@ class PdcReleaseMigrationTool(object):
 
         return data
 
-    def _bulk_insert(self, resource, data):
+    def _add_plan_step(self, resource, method, item_ids, batches):
+        """Record bulk operation into the plan"""
+
+        payload_bytes = [len(json.dumps(batch).encode("utf-8")) for batch in batches]
+        self._plan.append({
+            "resource": resource,
+            "method": method,
+            "items": item_ids,
+            "batches": batches,
+            "payload_bytes": sum(payload_bytes),
+            "requests": len(batches),
+        })
+
+        self._info("%s: Planned %s of %d items in %d requests (%d bytes)"
+                   % (resource, method, len(item_ids), len(batches), sum(payload_bytes)))
+
+    def _bulk_insert(self, resource, data, item_ids=None):
         """Bulk insert of several items at once.
 
         Items are split into batches by self.BATCH_SIZE num of items.
+
+        :param item_ids: List of ids of the inserted items (used in the plan)
         """
 
+        if self._plan is not None:
+            batches = [data[i:(i + self.BATCH_SIZE)]
+                       for i in range(0, len(data), self.BATCH_SIZE)]
+            self._add_plan_step(resource, "POST", item_ids or [], batches)
+            return
+
         for i in range(0, len(data), self.BATCH_SIZE):
             batch = data[i:(i + self.BATCH_SIZE)]
 
@@ -110,14 +146,45 @@ class PdcReleaseMigrationTool(object):
 
             self.client[resource]._(batch)
 
+    def _bulk_update(self, resource, data):
+        """Bulk update (PATCH) of several items at once.
+
+        :param data: Is dict {primary key: {fields to update}}
+
+        Items are split into batches by self.BATCH_SIZE num of items.
+        """
+
+        keys = sorted(data)
+
+        if self._plan is not None:
+            batches = [dict((key, data[key]) for key in keys[i:(i + self.BATCH_SIZE)])
+                       for i in range(0, len(keys), self.BATCH_SIZE)]
+            self._add_plan_step(resource, "PATCH", keys, batches)
+            return
+
+        for i in range(0, len(keys), self.BATCH_SIZE):
+            batch = dict((key, data[key]) for key in keys[i:(i + self.BATCH_SIZE)])
+
+            self._debug("Batch update of '%s':" % resource)
+            self._debug(pprint.pformat(batch))
+
+            if self._test:
+                continue
+
+            res = self.client[resource]
+            res += batch
+
     def _create_missing_items(self, resource, items, selector, needed_items,
                               readonlyattrs, query_param=None):
-        """Create missing items on PDC server"""
+        """Create missing items on PDC server
+
+        Return set of selector values of the created items.
+        """
 
         # Debug
         if not needed_items:
             self._debug("%s: No need to add any items" % resource)
-            return  # Nothing to do
+            return set()  # Nothing to do
 
         missing = self._filter_existing_items(resource, selector, needed_items, query_param)
 
@@ -128,39 +195,201 @@ class PdcReleaseMigrationTool(object):
         # No additional items needed
         if not missing:
             self._debug("%s: No need to add any new items" % resource)
-            return
+            return set()
 
         # Add missing items
         data = self._prepare_post_data(resource, items, selector, missing, readonlyattrs)
 
         if not data:
-            return  # Nothing to do
+            return set()  # Nothing to do
+
+        created = [selector(item) for item in items if selector(item) in missing]
 
         # Import data into PDC
-        self._bulk_insert(resource, data)
+        self._bulk_insert(resource, data, created)
 
-    def _get_releases(self, release_ids):
-        if not release_ids:
-            releases = self.client['releases'](page_size=-1)
-            for release in releases:
-                if release["release_id"] not in release_ids:
-                    continue
-                self._releases.append(release)
+        return set(created)
+
+    def _parse_release_pattern(self, pattern):
+        """Parse release_id pattern
+
+        Pattern is either exact release_id, glob (e.g. 'foo-1.*')
+        or regex with 're:' prefix (e.g. 're:^foo-1\\.[0-9]+$').
+
+        Return tuple (match function or None for exact release_id,
+        release short usable for server-side filtering or None).
+        """
+
+        if pattern.startswith(self.REGEX_PREFIX):
+            regex = re.compile(pattern[len(self.REGEX_PREFIX):])
+            match = regex.search
+            if not regex.pattern.startswith("^") or "|" in regex.pattern:
+                return match, None  # No usable prefix
+            prefix_source, special = regex.pattern[1:], self.REGEX_CHARS
+        elif any(char in pattern for char in self.GLOB_CHARS):
+            match = re.compile(fnmatch.translate(pattern)).match
+            prefix_source, special = pattern, self.GLOB_CHARS
+        else:
+            return None, None
+
+        # Literal prefix of the pattern
+        prefix = prefix_source
+        for i, char in enumerate(prefix_source):
+            if char in special:
+                prefix = prefix_source[:i]
+                if special == self.REGEX_CHARS and char in "*+?{":
+                    prefix = prefix[:-1]  # Quantifier makes the preceding char optional
+                break
+
+        # Release short is followed by a dash and version starting with digit
+        short_match = re.match(r"^(.+?)-[0-9]", prefix)
+        return match, short_match.group(1) if short_match else None
+
+    def _add_releases(self, releases, matches=None):
+        """Add releases to self._releases
+
+        :param matches: List of match functions or None. If specified, only
+                        releases with release_id matching any of them are added.
+        """
+
+        known_ids = set(release["release_id"] for release in self._releases)
+        for release in releases:
+            if release["release_id"] in known_ids:
+                continue
+            if matches and not any(match(release["release_id"]) for match in matches):
+                continue
+            known_ids.add(release["release_id"])
+            self._releases.append(release)
+
+    def _get_releases(self, release_ids, products=None, product_versions=None):
+        """Get releases selected by release_ids, products and product_versions
+
+        :param release_ids: List of exact release_ids or patterns
+                            (see _parse_release_pattern)
+        :param products: List of product shorts
+        :param product_versions: List of product_version_ids
+
+        Selected releases are union of all selectors. If no selector is
+        specified, all releases are selected.
+
+        Return False if any of the patterns is invalid.
+        """
+
+        release_ids = release_ids or []
+        product_versions = list(product_versions or [])
+
+        if not release_ids and not products and not product_versions:
+            self._add_releases(self.client['releases'](page_size=-1))
+            return True
+
+        # Sort release_ids into exact ids and patterns
+        exact_ids = []
+        matchers = []  # List of (match function, release short or None)
+        for release_id in release_ids:
+            try:
+                match, short = self._parse_release_pattern(release_id)
+            except re.error as err:
+                self._error("Bad release pattern '%s': %s" % (release_id, err))
+                return False
+            if match is None:
+                exact_ids.append(release_id)
+            else:
+                matchers.append((match, short))
+
+        # Exact release_ids
+        if exact_ids:
+            self._add_releases(self.client['releases'](release_id=exact_ids,
+                                                       page_size=-1))
+
+        # Patterns
+        # Candidates are filtered by release short on the server side,
+        # all releases are scanned only for patterns without usable prefix
+        if any(short is None for _, short in matchers):
+            self._debug("releases: Pattern without release short, scanning all releases")
+            candidates = self.client['releases'](page_size=-1)
+            self._add_releases(candidates, [match for match, _ in matchers])
         else:
-            releases = self.client['releases'](release_id=release_ids,
-                                               page_size=-1)
-            self._releases = releases
+            for short in sorted(set(short for _, short in matchers)):
+                candidates = self.client['releases'](short=short, page_size=-1)
+                self._add_releases(candidates, [match for match, s in matchers if s == short])
+
+        # Products
+        for product in products or []:
+            for t_product in self.client['products'](short=product, page_size=-1):
+                product_versions.extend(t_product.get("product_versions", []))
+
+        # Product versions
+        queried_product_versions = set()
+        for product_version in product_versions:
+            if product_version in queried_product_versions:
+                continue
+            queried_product_versions.add(product_version)
+            self._add_releases(self.client['releases'](product_version=product_version,
+                                                       page_size=-1))
+
+        return True
 
     def _post_releases(self, release_ids):
-        """Bulk create of releases"""
+        """Bulk create of releases
+
+        Return set of release_ids of the created releases.
+        """
 
         # Create missing items in PDC
-        self._create_missing_items("releases",
-                                   self._releases,
-                                   operator.itemgetter("release_id"),
-                                   set(release_ids),
-                                   ["compose_set", "release_id", "integrated_with"],
-                                   query_param=('release_id', release_ids))
+        # Field integrated_with is set later by _post_releases_integrated_with
+        # because the referenced release doesn't have to exist yet
+        return self._create_missing_items("releases",
+                                          self._releases,
+                                          operator.itemgetter("release_id"),
+                                          set(release_ids),
+                                          ["compose_set", "release_id", "integrated_with"],
+                                          query_param=('release_id', release_ids))
+
+    def _post_releases_integrated_with(self, release_ids, created_release_ids):
+        """Bulk update of integrated_with of the newly created releases"""
+
+        # Index of releases which are being loaded
+        # All of them exist on the server after _post_releases
+        loaded_releases = dict((release["release_id"], release)
+                               for release in self._releases
+                               if release["release_id"] in release_ids)
+
+        # Get list of integrated_with values we need to set
+        needed_links = {}
+        for release_id in sorted(created_release_ids):
+            release = loaded_releases.get(release_id)
+            if not release or not release.get("integrated_with"):
+                continue
+            needed_links[release_id] = release["integrated_with"]
+
+        if not needed_links:
+            self._debug("releases: No need to set any integrated_with")
+            return
+
+        # Releases referenced from outside of the loaded set must already
+        # exist on the server
+        external_ids = sorted(set(needed_links.values()) - set(loaded_releases))
+        missing = set()
+        if external_ids:
+            available = self.client['releases'](release_id=external_ids, page_size=-1)
+            missing = set(external_ids) - set(release["release_id"] for release in available)
+
+        # Prepare update data
+        data = {}
+        for release_id, integrated_with in sorted(needed_links.items()):
+            if integrated_with in missing:
+                self._warning("releases: Cannot set integrated_with of '%s', "
+                              "release '%s' doesn't exist" % (release_id, integrated_with))
+                continue
+            self._info("releases: Going to set integrated_with of '%s' to '%s'"
+                       % (release_id, integrated_with))
+            data[release_id] = {"integrated_with": integrated_with}
+
+        if not data:
+            return  # Nothing to do
+
+        # Update data in PDC
+        self._bulk_update("releases", data)
 
     def _get_release_variants(self):
         for release in self._releases:
@@ -318,8 +547,10 @@ class PdcReleaseMigrationTool(object):
                                    needed_base_product_ids,
                                    ["base_product_id"])
 
-    def dump(self, f, release_ids):
-        self._get_releases(release_ids)
+    def dump(self, f, release_ids, products=None, product_versions=None):
+        if not self._get_releases(release_ids, products, product_versions):
+            return False
+        release_ids = [release["release_id"] for release in self._releases]
         self._get_release_variants()
         self._get_content_delivery_repos()
         self._get_product_versions(release_ids)
@@ -384,8 +615,94 @@ class PdcReleaseMigrationTool(object):
         self._post_base_products(release_ids)
         self._post_products(release_ids)
         self._post_product_versions(release_ids)
-        self._post_releases(release_ids)
+        created_release_ids = self._post_releases(release_ids)
         self._post_release_variants(release_ids)
         self._post_content_delivery_repos(release_ids)
+        self._post_releases_integrated_with(release_ids, created_release_ids)
+
+        return True
+
+    def plan(self, f, plan_f, release_ids):
+        """Write plan of the load into plan_f instead of loading data into PDC"""
+
+        self._plan = []
+        try:
+            if not self.load(f, release_ids):
+                return False
+            steps = self._plan
+        finally:
+            self._plan = None
+
+        ret = [{
+            "name": self.NAME,
+            "version": 1,
+            "type": "plan",
+        }, {
+            "steps": steps,
+            "payload_bytes": sum(step["payload_bytes"] for step in steps),
+            "requests": sum(step["requests"] for step in steps),
+        }]
+
+        self._info("Plan: %d requests (%d bytes)" % (ret[1]["requests"], ret[1]["payload_bytes"]))
+
+        json.dump(ret, plan_f, indent=2, separators=(',', ': '), sort_keys=True)
+
+        return True
+
+    def execute_plan(self, f):
+        """Execute plan created by plan method"""
+
+        try:
+            data = json.load(f)
+        except ValueError as err:
+            self._error("Bad plan file format: %s" % err)
+            return False
+
+        # Check input data format
+        if (not isinstance(data, list)
+                or len(data) != 2
+                or not isinstance(data[0], dict)
+                or not isinstance(data[1], dict)
+                or data[0].get("type") != "plan"):
+            self._error("Bad plan file format")
+            return False
+
+        header, data = data
+
+        # Check header
+        if header.get("name") != self.NAME:
+            self._warning("Bad format name '%s'" % header.get("name"))
+
+        # Check all steps before anything is sent
+        steps = data.get("steps", [])
+        batch_types = {"POST": list, "PATCH": dict}
+        if not isinstance(steps, list):
+            self._error("Bad plan file format")
+            return False
+        for step in steps:
+            if (not isinstance(step, dict)
+                    or step.get("method") not in batch_types
+                    or not isinstance(step.get("resource"), STRING_TYPES)
+                    or not isinstance(step.get("batches"), list)
+                    or not all(isinstance(batch, batch_types[step["method"]])
+                               for batch in step["batches"])):
+                self._error("Bad plan file format")
+                return False
+
+        # Execute steps in the planned order
+        for step in steps:
+            resource = step["resource"]
+            for batch in step["batches"]:
+                self._debug("Batch %s of '%s':" % (step["method"], resource))
+                self._debug(pprint.pformat(batch))
+
+                if self._test:
+                    continue
+
+                if step["method"] == "PATCH":
+                    res = self.client[resource]
+                    res += batch
+                else:
+                    self.client[resource]._(batch)
 
         return True
@@ -6,6 +6,7 @@
 import os
 import sys
 import copy
+import json
 import operator
 import unittest
 try:
@@ -181,6 +182,165 @@ class TestCasePdcReleaseMigrationTool(unittest.TestCase):
         # Assert that data was posted in three chunks
         self.assertEqual(len(client_mock[resource].mock_calls), 3)
 
+    def test_bulk_update(self):
+        """Test that bulk update does chunking properly"""
+
+        # Server mock
+        client_mock = mock.MagicMock()
+
+        # Input parameters
+        resource = "test-resource"
+        data = dict((str(i), {"size": i})
+                    for i in range(0, PdcReleaseMigrationTool.BATCH_SIZE * 2 + 1))
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        rmt._bulk_update(resource, data)
+
+        # Assert that data was patched in three chunks
+        calls = client_mock[resource].__iadd__.mock_calls
+        self.assertEqual(len(calls), 3)
+
+        # Assert that every item was patched exactly once
+        patched = {}
+        for c in calls:
+            patched.update(c[1][0])
+        self.assertEqual(patched, data)
+
+    def test_post_releases_integrated_with(self):
+        """Test _post_releases_integrated_with method"""
+
+        # Server mock
+        # * Only 'ext-1.0' exists on the server
+        client_mock = mock.MagicMock()
+        client_mock["releases"].return_value = [{"release_id": "ext-1.0"}]
+
+        # Input parameters
+        release_ids = ["foo-1.0", "foo-1.1", "foo-1.2", "foo-1.3", "bar-1.0"]
+        created_release_ids = set(["foo-1.0", "foo-1.1", "foo-1.2", "foo-1.3"])
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        rmt._releases = [
+            {"release_id": "foo-1.0", "integrated_with": None},
+            {"release_id": "foo-1.1", "integrated_with": "bar-1.0"},
+            {"release_id": "foo-1.2", "integrated_with": "ext-1.0"},
+            {"release_id": "foo-1.3", "integrated_with": "missing-1.0"},
+            {"release_id": "bar-1.0", "integrated_with": "foo-1.0"},
+        ]
+        rmt._post_releases_integrated_with(release_ids, created_release_ids)
+
+        # Expect that
+        # * Only releases referenced from outside of the loaded set were queried
+        #   and all of them by a single query
+        # * Only created releases with existing target release were updated
+        expected = [
+            call(page_size=-1, release_id=['ext-1.0', 'missing-1.0']),
+        ]
+        self.assertEqual(client_mock["releases"].call_args_list, expected)
+        client_mock["releases"].__iadd__.assert_called_once_with({
+            "foo-1.1": {"integrated_with": "bar-1.0"},
+            "foo-1.2": {"integrated_with": "ext-1.0"},
+        })
+
+    def test_parse_release_pattern(self):
+        """Test _parse_release_pattern method"""
+
+        rmt = PdcReleaseMigrationTool(None)
+
+        # Exact release_id
+        self.assertEqual(rmt._parse_release_pattern("foo-1.0"), (None, None))
+
+        # Patterns with usable release short
+        match, short = rmt._parse_release_pattern("foo-bar-1.*")
+        self.assertEqual(short, "foo-bar")
+        self.assertTrue(match("foo-bar-1.2"))
+        self.assertFalse(match("foo-bar-2.0"))
+
+        match, short = rmt._parse_release_pattern("re:^foo-1\\.[0-9]+$")
+        self.assertEqual(short, "foo")
+        self.assertTrue(match("foo-1.12"))
+        self.assertFalse(match("foo-1.x"))
+
+        # Patterns without usable release short
+        for pattern in ["foo-*", "*-1.0", "re:foo-1", "re:^foo-1|bar-1", "re:^foo-1?"]:
+            match, short = rmt._parse_release_pattern(pattern)
+            self.assertIsNotNone(match)
+            self.assertIsNone(short)
+
+    def test_get_releases_with_patterns(self):
+        """Test _get_releases method with exact release_ids and patterns"""
+
+        # Server mock
+        client_mock = mock.MagicMock()
+        client_mock["releases"].side_effect = [
+            [{"release_id": "foo-1.0"}],
+            [{"release_id": "foo-1.0"}, {"release_id": "foo-1.1"}, {"release_id": "foo-2.0"}],
+        ]
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        rmt._get_releases(["foo-1.0", "foo-1.*"])
+
+        # Expect that
+        # * Pattern was expanded by query filtered by release short
+        # * Each release is selected only once
+        expected = [
+            call(page_size=-1, release_id=["foo-1.0"]),
+            call(page_size=-1, short="foo"),
+        ]
+        self.assertEqual(client_mock["releases"].call_args_list, expected)
+        self.assertEqual([r["release_id"] for r in rmt._releases],
+                         ["foo-1.0", "foo-1.1"])
+
+    def test_get_releases_with_products(self):
+        """Test _get_releases method with product and product version selectors"""
+
+        # Server mock
+        resources = {
+            "products": mock.Mock(return_value=[{"short": "foo", "product_versions": ["foo-1", "bar-2"]}]),
+            "releases": mock.Mock(side_effect=[
+                [{"release_id": "bar-2.0"}],
+                [{"release_id": "foo-1.0"}],
+            ]),
+        }
+        client_mock = mock.MagicMock()
+        client_mock.__getitem__.side_effect = resources.__getitem__
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        ret = rmt._get_releases(None, products=["foo"], product_versions=["bar-2"])
+        self.assertTrue(ret)
+
+        # Expect that
+        # * Product versions were resolved through the product
+        # * Releases were queried by product versions, each only once
+        resources["products"].assert_called_once_with(page_size=-1, short="foo")
+        expected = [
+            call(page_size=-1, product_version="bar-2"),
+            call(page_size=-1, product_version="foo-1"),
+        ]
+        self.assertEqual(client_mock["releases"].call_args_list, expected)
+        self.assertEqual([r["release_id"] for r in rmt._releases],
+                         ["bar-2.0", "foo-1.0"])
+
+    def test_dump_with_invalid_regex(self):
+        """Test dump method with invalid regex pattern"""
+
+        # Server mock
+        client_mock = mock.MagicMock()
+
+        # Input parameters
+        f = StringIO()
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        ret = rmt.dump(f, ["foo-1.0", "re:^foo-["])
+
+        # Assert negative return value and that nothing was queried
+        self.assertFalse(ret)
+        client_mock["releases"].assert_not_called()
+
     def test_dump_01(self):
         """Test dump method"""
 
@@ -291,6 +451,123 @@ class TestCasePdcReleaseMigrationTool(unittest.TestCase):
         # Assert negative return value
         self.assertFalse(ret)
 
+    def test_plan(self):
+        """Test that plan records bulk requests instead of sending them"""
+
+        # Server mock
+        # * No items exist on the server
+        client_mock = mock.MagicMock()
+        client_mock["releases"].return_value = []
+
+        # Input parameters
+        f = StringIO(json.dumps([{"name": PdcReleaseMigrationTool.NAME, "version": 1}, {
+            "releases": [
+                {"release_id": "foo-1.0", "integrated_with": None},
+                {"release_id": "foo-1.1", "integrated_with": "foo-1.0"},
+            ],
+            "release-variants": [],
+            "content-delivery-repos": [],
+            "product-versions": [],
+            "products": [],
+            "base-products": [],
+        }]))
+        plan_f = StringIO()
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        ret = rmt.plan(f, plan_f, None)
+
+        # Assert success
+        self.assertTrue(ret)
+
+        # Assert that nothing was sent to the server
+        client_mock["releases"]._.assert_not_called()
+        client_mock["releases"].__iadd__.assert_not_called()
+
+        # Assert the plan content
+        header, plan = json.loads(plan_f.getvalue())
+        self.assertEqual(header["type"], "plan")
+        self.assertEqual([(s["resource"], s["method"], s["items"], s["requests"]) for s in plan["steps"]], [
+            ("releases", "POST", ["foo-1.0", "foo-1.1"], 1),
+            ("releases", "PATCH", ["foo-1.1"], 1),
+        ])
+        self.assertEqual(plan["steps"][1]["batches"], [{"foo-1.1": {"integrated_with": "foo-1.0"}}])
+        self.assertEqual(plan["steps"][1]["payload_bytes"],
+                         len(json.dumps({"foo-1.1": {"integrated_with": "foo-1.0"}})))
+        self.assertEqual(plan["requests"], 2)
+
+    def test_execute_plan(self):
+        """Test that execute_plan sends planned batches"""
+
+        # Server mock
+        client_mock = mock.MagicMock()
+
+        # Input parameters
+        f = StringIO(json.dumps([{"name": PdcReleaseMigrationTool.NAME, "version": 1, "type": "plan"}, {
+            "steps": [
+                {"resource": "releases", "method": "POST", "batches": [[{"short": "foo"}], [{"short": "bar"}]]},
+                {"resource": "releases", "method": "PATCH", "batches": [{"foo-1.1": {"integrated_with": "foo-1.0"}}]},
+            ],
+        }]))
+
+        # Test
+        rmt = PdcReleaseMigrationTool(client_mock)
+        ret = rmt.execute_plan(f)
+
+        # Assert success
+        self.assertTrue(ret)
+
+        # Assert that planned batches were sent without any queries
+        client_mock["releases"].assert_not_called()
+        self.assertEqual(client_mock["releases"]._.mock_calls,
+                         [call([{"short": "foo"}]), call([{"short": "bar"}])])
+        client_mock["releases"].__iadd__.assert_called_once_with({"foo-1.1": {"integrated_with": "foo-1.0"}})
+
+    def test_execute_plan_with_dump_file(self):
+        """Test execute_plan with dump file instead of plan"""
+
+        # Input parameters
+        f = StringIO('[{"name": "%s", "version": 1}, {}]' % PdcReleaseMigrationTool.NAME)
+
+        # Test
+        rmt = PdcReleaseMigrationTool(None)
+        ret = rmt.execute_plan(f)
+
+        # Assert negative return value
+        self.assertFalse(ret)
+
+    def test_execute_plan_with_bad_steps(self):
+        """Test execute_plan with malformed steps (nothing should be sent)"""
+
+        bad_steps = [
+            "step",
+            {"method": "POST"},
+            {"method": "POST", "resource": "releases", "batches": {"foo": {}}},
+            {"method": "PATCH", "resource": "releases", "batches": [[{"short": "foo"}]]},
+            {"method": "DELETE", "resource": "releases", "batches": []},
+        ]
+
+        for bad_step in bad_steps:
+            # Server mock
+            client_mock = mock.MagicMock()
+
+            # Input parameters
+            # * Valid step is followed by the malformed one
+            f = StringIO(json.dumps([{"name": PdcReleaseMigrationTool.NAME, "version": 1, "type": "plan"}, {
+                "steps": [
+                    {"resource": "releases", "method": "POST", "batches": [[{"short": "foo"}]]},
+                    bad_step,
+                ],
+            }]))
+
+            # Test
+            rmt = PdcReleaseMigrationTool(client_mock)
+            ret = rmt.execute_plan(f)
+
+            # Assert negative return value and that nothing was sent
+            self.assertFalse(ret)
+            client_mock["releases"]._.assert_not_called()
+
 
 if __name__ == '__main__':
     unittest.main()